@@ -1,15 +1,158 @@
 "Maintain a set of cron jobs in the code repository"
 
-import collections
+import concurrent.futures
 import datetime
+import functools
 import heapq
+import itertools
+import mmap
+import operator
 import os
 import re
-import shlex
+import socket
 import subprocess
+import tempfile
 import typing
 
-import croniter
+
+@functools.lru_cache(maxsize=None)
+def _expand_cron(expr_format: str, **kwargs: typing.Any) -> typing.Any:
+    "Parse a cron expression once and cache the expansion"
+    import croniter  # pylint: disable=import-outside-toplevel
+    return croniter.croniter._expand(expr_format, **kwargs)
+
+
+MasksType = typing.Tuple[int, int, int, int, int, bool, bool]
+
+_FIELD_LOWS = (0, 0, 1, 1, 0)
+"Lowest allowed value of each cron field"
+_FIELD_HIGHS = (59, 23, 31, 12, 7)
+"Highest allowed value of each cron field"
+
+
+@functools.lru_cache(maxsize=None)
+def _cron_masks(cron_fmt: str) -> typing.Optional[MasksType]:
+    """Convert a cron time format to field bitmaps
+
+    The field values come from croniter's own (cached) expansion, so
+    the accepted value sets are exactly croniter's.  Returns None if
+    the format uses features beyond plain value lists (e.g. nth
+    weekday), in which case the caller falls back to croniter.
+
+    Args:
+        cron_fmt: The 5-field cron time format
+
+    """
+    import croniter  # pylint: disable=import-outside-toplevel
+    try:
+        expanded_info = _expand_cron(cron_fmt)
+    except croniter.CroniterError:
+        return None
+    # Older croniter returns only (expanded, nth_weekday_of_month)
+    expanded, nth_weekday_of_month = expanded_info[0], expanded_info[1]
+    nearest_weekday = expanded_info[3] if len(expanded_info) > 3 else None
+    if len(expanded) != 5 or nth_weekday_of_month or nearest_weekday:
+        return None
+    masks = []
+    for values, low, high in zip(expanded, _FIELD_LOWS, _FIELD_HIGHS):
+        if values == ['*']:
+            mask = (1 << (high + 1)) - (1 << low)
+        else:
+            mask = 0
+            for val in values:
+                if not isinstance(val, int) or not low <= val <= high:
+                    return None
+                mask |= 1 << val
+        masks.append(mask)
+    dow_mask = masks[4]
+    if dow_mask >> 7 & 1:  # 0 and 7 both mean Sunday
+        dow_mask = (dow_mask | 1) & 0x7f
+    return (masks[0], masks[1], masks[2], masks[3], dow_mask,
+            expanded[2] == ['*'], expanded[4] == ['*'])
+
+
+def _next_bit(mask: int, pos: int) -> int:
+    "Find the lowest set bit of mask at or above pos, or -1 if none"
+    mask >>= pos
+    if not mask:
+        return -1
+    return pos + (mask & -mask).bit_length() - 1
+
+
+def _gen_simple(masks: MasksType,
+                start: datetime.datetime) -> typing.Iterator[
+                    datetime.datetime]:
+    """Generate schedule times after start from cron field bitmaps
+
+    Follows cron matching rules: when both the day and day-of-week
+    fields are restricted, a date matching either is accepted.
+
+    Args:
+        masks: Field bitmaps as returned by _cron_masks
+        start: Generate times strictly after this time
+
+    """
+    (min_mask, hr_mask, day_mask, mon_mask, dow_mask,
+     day_star, dow_star) = masks
+    dt = start.replace(second=0, microsecond=0) \
+        + datetime.timedelta(minutes=1)
+    one_day = datetime.timedelta(days=1)
+    skipped = 0
+    while True:
+        day_hit = day_mask >> dt.day & 1
+        dow_hit = dow_mask >> (dt.weekday() + 1) % 7 & 1
+        if mon_mask >> dt.month & 1 and (
+                dow_hit if day_star else
+                day_hit if dow_star else day_hit or dow_hit):
+            hour = dt.hour
+            minute = dt.minute
+            while True:
+                nxt_hr = _next_bit(hr_mask, hour)
+                if nxt_hr < 0:
+                    break
+                if nxt_hr != hour:
+                    hour = nxt_hr
+                    minute = 0
+                nxt_min = _next_bit(min_mask, minute)
+                if nxt_min < 0:
+                    hour += 1
+                    minute = 0
+                    continue
+                skipped = -1
+                yield dt.replace(hour=hour, minute=nxt_min)
+                minute = nxt_min + 1
+        dt = (dt + one_day).replace(hour=0, minute=0)
+        skipped += 1
+        if skipped > 366 * 50:  # Mirror croniter's 50-year search bound
+            import croniter  # pylint: disable=import-outside-toplevel
+            raise croniter.CroniterBadDateError(
+                'No matching date for cron specification')
+
+
+@functools.lru_cache(maxsize=1)
+def _cached_croniter() -> type:
+    """Build a croniter subclass that reuses cached expression parses
+
+    Identical expressions occur repeatedly when listing invocations,
+    so the string-to-fieldset parse is done only once per distinct
+    expression.  The expanded field lists are copied per instance to
+    keep the cached value immutable.  The subclass is created lazily so
+    importing cronrepo does not pull in croniter; most cron_run
+    invocations never need it.
+
+    """
+    import croniter  # pylint: disable=import-outside-toplevel
+
+    class _CachedCroniter(croniter.croniter):
+        "croniter deferring expression expansion to _expand_cron"
+        @classmethod
+        def _expand(cls, expr_format: str,
+                    **kwargs: typing.Any) -> typing.Any:
+            expanded_info = _expand_cron(expr_format, **kwargs)
+            return (([list(entry) for entry in expanded_info[0]],)
+                    + tuple(expanded_info[1:]))
+
+    return _CachedCroniter
 
 
 class CronSpec:
@@ -30,26 +173,57 @@ class CronSpec:
             command
 
     """
-    CRON_LINE_RE = re.compile(r'''
-        ^\#\s*
-        CRON@(?P<target>\w*)
-        (?:%(?P<jid>\w+))?
-        :(?P<level>(?:[+-]?[0-9]+)?):
-        (?P<min> [-,*/\d]+)\s+
-        (?P<hr> [-,*/\d]+)\s+
-        (?P<day> [-,*/\d]+)\s+
-        (?P<mon> [-,*/\d]+)\s+
-        (?P<dow> [-,*/\d]+)\s*
-        (?:
-            \+ (?P<args> .*)
-            |
-        )$
-      ''', re.X)
+    CRON_LINE_RE = re.compile(
+        r'^\#\s*'
+        r'CRON@(?P<target>\w*)'
+        r'(?:%(?P<jid>\w+))?'
+        r':(?P<level>(?:[+-]?[0-9]+)?):'
+        r'(?P<min>[-,*/\d]+)\s+'
+        r'(?P<hr>[-,*/\d]+)\s+'
+        r'(?P<day>[-,*/\d]+)\s+'
+        r'(?P<mon>[-,*/\d]+)\s+'
+        r'(?P<dow>[-,*/\d]+)\s*'
+        r'(?:\+(?P<args>.*)|)$')
     "Regex to recognize cron lines to cron info"
+    CRON_LINE_RE_B = re.compile(
+        rb'^\#[ \t]*'
+        rb'CRON@(?P<target>\w*)'
+        rb'(?:%(?P<jid>\w+))?'
+        rb':(?P<level>(?:[+-]?[0-9]+)?):'
+        rb'(?P<min>[-,*/\d]+)[ \t]+'
+        rb'(?P<hr>[-,*/\d]+)[ \t]+'
+        rb'(?P<day>[-,*/\d]+)[ \t]+'
+        rb'(?P<mon>[-,*/\d]+)[ \t]+'
+        rb'(?P<dow>[-,*/\d]+)[ \t]*'
+        rb'(?:\+(?P<args>.*?)|)\r?$', re.M)
+    "Bytes version of CRON_LINE_RE for scanning whole files"
+    CRON_MARK = b'CRON@'
+    "Marker bytes gating the regex match when scanning files"
+
+    __slots__ = ('path', 'target', 'jid', 'min', 'hr', 'day', 'mon', 'dow',
+                 'args', '_level', '_cron_fmt', '_name', '_sort_key',
+                 '_cmd_tail')
 
     def __init__(self, path: str, cron_info: typing.Dict[str, str]) -> None:
         self.path = path
-        self.cron_info = {key: val or '' for key, val in cron_info.items()}
+        self.target = cron_info['target'] or ''
+        self.jid = cron_info['jid'] or ''
+        self.min = cron_info['min'] or ''
+        self.hr = cron_info['hr'] or ''
+        self.day = cron_info['day'] or ''
+        self.mon = cron_info['mon'] or ''
+        self.dow = cron_info['dow'] or ''
+        self.args = cron_info['args'] or ''
+        self._level = int(cron_info['level'] or '0')
+        self._cron_fmt \
+            = f'{self.min} {self.hr} {self.day} {self.mon} {self.dow}'
+        name = os.path.basename(path)
+        self._name = name if not self.jid else f'{name}%{self.jid}'
+        self._sort_key = ('*' if self.dow == '1-5' else self.dow,
+                          self.hr, self.min, self._name)
+        args = self.args.strip()
+        self._cmd_tail = f'{self.target} \'{self.jid}\' {path}' \
+            + (f' {args}' if args else '')
 
     @classmethod
     def find_cron_specs(cls, path: str, target: str) \
@@ -61,11 +235,26 @@ class CronSpec:
             target: If non-empty, yield jobs only for those with this target
 
         """
-        with open(path) as fin:
-            for line in fin:
-                spec = cls.recognize_cron_line(path, line)
-                if spec and (not target or spec.cron_info['target'] == target):
-                    yield spec
+        with open(path, 'rb') as fin:
+            data = None  # type: typing.Union[None, mmap.mmap, bytes]
+            try:
+                data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):  # e.g. empty or special file
+                data = fin.read()
+            try:
+                if data.find(b'\x00', 0, 4096) >= 0:  # binary file
+                    return
+                if data.find(cls.CRON_MARK) < 0:
+                    return
+                for match in cls.CRON_LINE_RE_B.finditer(data):
+                    spec = cls(path, {
+                        key: val.decode('utf-8', 'replace') if val else ''
+                        for key, val in match.groupdict().items()})
+                    if not target or spec.target == target:
+                        yield spec
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
 
     @classmethod
     def recognize_cron_line(cls, path: str,
@@ -84,15 +273,11 @@ class CronSpec:
 
     def name(self) -> str:
         "Get name of the job represented"
-        name = os.path.basename(self.path)
-        jid = self.cron_info['jid']
-        return name if not jid else '%'.join([name, jid])
+        return self._name
 
     def sort_key(self) -> typing.Tuple[str, str, str, str]:
         """Get a sort key for ordering the cron lines"""
-        info = self.cron_info
-        return ('*' if info['dow'] == '1-5' else info['dow'],
-                info['hr'], info['min'], self.name())
+        return self._sort_key
 
     def cron_line(self, runner: str) -> str:
         """Get the line to be used as a cron job entry
@@ -106,18 +291,11 @@ class CronSpec:
                 line.
 
         """
-        return self.cron_fmt() + ' ' + self.cmd_str(runner)
+        return f'{self.cron_fmt()} {self.cmd_str(runner)}'
 
     def cron_fmt(self) -> str:
         "Get the time format in the cron line"
-        info = self.cron_info
-        return ' '.join([
-            info['min'],
-            info['hr'],
-            info['day'],
-            info['mon'],
-            info['dow'],
-        ])
+        return self._cron_fmt
 
     def cmd_str(self, runner: str) -> str:
         """Return the command string
@@ -126,14 +304,7 @@ class CronSpec:
             runner: The path to the runner script
 
         """
-        info = self.cron_info
-        args = info['args'].strip()
-        return ' '.join([
-            runner,
-            info['target'],
-            '\'%s\'' % info['jid'],
-            self.path,
-        ] + ([args] if args else []))
+        return f'{runner} {self._cmd_tail}'
 
     def gen_inv(self, start: datetime.datetime, iid: int) \
             -> typing.Iterator['CronInv']:
@@ -144,19 +315,113 @@ class CronSpec:
             iid: The invocation ID of the invocations to generate
 
         """
-        itr = croniter.croniter(self.cron_fmt(), start)
+        masks = _cron_masks(self.cron_fmt())
+        if masks is not None:
+            for idt in _gen_simple(masks, start):
+                yield CronInv(idt, iid, self)
+            return
+        itr = _cached_croniter()(self.cron_fmt(), start)
         while True:
             idt = itr.get_next(ret_type=datetime.datetime)
             yield CronInv(idt, iid, self)
 
     def level(self) -> int:
         "Get level number of the cron job"
-        return int(self.cron_info['level'] or '0')
+        return self._level
 
 
 GrpKeyType = typing.Tuple[int, str]
 GrpMapType = typing.Dict[GrpKeyType, typing.List[CronSpec]]
 
+_UNSAFE_VALUE_RE = re.compile(r'[^\w@%+=:,./-]', re.ASCII)
+"Regex finding characters that require shell quoting"
+
+
+def _quote(value: str) -> str:
+    """Quote a string for use in a shell script
+
+    Same quoting rule as shlex.quote, with the regex precompiled and
+    the already-safe common case returned unchanged without a call into
+    shlex.
+
+    Args:
+        value: The string to quote
+
+    """
+    if value and not _UNSAFE_VALUE_RE.search(value):
+        return value
+    return "'" + value.replace("'", "'\"'\"'") + "'"
+
+
+_MULTI_CHARS = frozenset(',-/*')
+"Characters marking a minute or hour field as multi-valued"
+_WEEKDAY_DOW_CHARS = frozenset('12345-*')
+"Characters in a day-of-week field that can match a weekday"
+_ANY_DAY_CHARS = frozenset('-*')
+"Characters in a day field that leave the day unrestricted"
+
+BUCKET_ORDER = (
+    (1, 'More frequent than daily'),
+    (3, 'Weekends'),
+    (4, 'Monthly'),
+    (5, 'Weekdays'),
+)  # type: typing.Tuple[GrpKeyType, ...]
+"Crontab section keys in output order"
+
+
+_MIN_PARALLEL_SCAN = 8
+"Minimum file count before scanning a cron directory with a thread pool"
+
+MAX_SCAN_BYTES = 1 << 20
+"Largest file size scanned for cron lines"
+
+
+def _iter_specs(path: str, target: str) -> typing.Iterator[CronSpec]:
+    """Iterate over the cron specs found in a cron directory
+
+    Large directories are scanned with a thread pool to overlap the
+    file reads; the GIL is released during I/O and the per-file CPU
+    work is small.
+
+    Args:
+        path: The path to the cron directory
+        target: If non-empty, yield jobs only for those with this target
+
+    """
+    paths = []
+    with os.scandir(path) as dir_it:
+        for entry in dir_it:
+            name = entry.name
+            if name.startswith('.') \
+               or name.endswith(('~', '.bak', '.swp', '.pyc')) \
+               or not entry.is_file() \
+               or entry.stat().st_size > MAX_SCAN_BYTES:
+                continue
+            paths.append(entry.path)
+    if len(paths) < _MIN_PARALLEL_SCAN:
+        for file_path in paths:
+            yield from CronSpec.find_cron_specs(file_path, target)
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        for specs in executor.map(
+                lambda file_path: list(
+                    CronSpec.find_cron_specs(file_path, target)),
+                paths):
+            yield from specs
+
+
+def _classify(spec: CronSpec) -> GrpKeyType:
+    "Find the crontab section key for a cron spec"
+    if not _MULTI_CHARS.isdisjoint(spec.min) \
+       or not _MULTI_CHARS.isdisjoint(spec.hr):
+        return BUCKET_ORDER[0]
+    if _WEEKDAY_DOW_CHARS.isdisjoint(spec.dow):
+        return BUCKET_ORDER[1]
+    if _ANY_DAY_CHARS.isdisjoint(spec.day):
+        return BUCKET_ORDER[2]
+    return BUCKET_ORDER[3]
+
 
 class CronDir:
     """Represent a cron directory that can be operated on
@@ -171,37 +436,27 @@ class CronDir:
     def __init__(self, path: str, target: str) -> None:
         self._path = path
         self._target = target
+        self._runner_path = None  # type: typing.Optional[str]
 
     def get_cron_lst(self) -> typing.List[CronSpec]:
         "Get a list of CronSpec for the cron directory"
-        ret = []  # type: typing.List[CronSpec]
-        for name in os.listdir(self._path):
-            path = os.path.join(self._path, name)
-            if not name.startswith('.') and not name.endswith('~') \
-               and not name.endswith('.bak') and os.path.isfile(path):
-                ret.extend(CronSpec.find_cron_specs(path, self._target))
-        return ret
+        return list(_iter_specs(self._path, self._target))
 
     def generate(self) -> str:
         "Generate crontab for the cron jobs specified in the cron directory"
-        cron_lst = self.get_cron_lst()
-        is_multi = set(',-/*').intersection
-        grouped = collections.defaultdict(list)  # type: GrpMapType
-        for spec in sorted(cron_lst, key=lambda spec: spec.sort_key()):
-            info = spec.cron_info
-            if is_multi(info['min']) or is_multi(info['hr']):
-                grouped[(1, 'More frequent than daily')].append(spec)
-            elif not set('12345-*').intersection(info['dow']):
-                grouped[(3, 'Weekends')].append(spec)
-            elif not set('-*').intersection(info['day']):
-                grouped[(4, 'Monthly')].append(spec)
-            else:
-                grouped[(5, 'Weekdays')].append(spec)
+        grouped = {key: [] for key in BUCKET_ORDER}  # type: GrpMapType
+        for spec in _iter_specs(self._path, self._target):
+            grouped[_classify(spec)].append(spec)
         ret = []
-        for header, specs in sorted(grouped.items()):
+        runner = self.runner_path()
+        for header in BUCKET_ORDER:
+            specs = grouped[header]
+            if not specs:
+                continue
+            specs.sort(key=CronSpec.sort_key)
             ret.append('# ' + header[1])
             for spec in specs:
-                ret.append(spec.cron_line(self.runner_path()))
+                ret.append(spec.cron_line(runner))
         start_marker, end_marker = self.markers()
         ret.insert(0, start_marker)
         ret.append(end_marker)
@@ -233,17 +488,18 @@ class CronDir:
 
         """
         runner = self.runner_path()
+        parts = ['#!/bin/bash']
+        for key, value in sorted(os.environ.items()):
+            if key in self.SKIPPED_ENVVAR or key.startswith('CRONREPO_'):
+                continue
+            parts.append('export ' + key + '=' + _quote(value))
+        parts.append('cd ' + _quote(os.getcwd()))
+        if trampoline:
+            trampoline = trampoline + ' '
+        parts.append('export CRONREPO_TARGET=$1\nexport CRONREPO_JID=$2\n'
+                     'shift 2\nexec ' + trampoline + '"$@"')
         with open(runner, 'wt') as fout:
-            print('#!/bin/bash', file=fout)
-            for key, value in sorted(os.environ.items()):
-                if key in self.SKIPPED_ENVVAR or key.startswith('CRONREPO_'):
-                    continue
-                print('export ' + key + '=' + shlex.quote(value), file=fout)
-            print('cd ' + shlex.quote(os.getcwd()), file=fout)
-            if trampoline:
-                trampoline = trampoline + ' '
-            print('export CRONREPO_TARGET=$1\nexport CRONREPO_JID=$2\nshift 2\n'
-                  + 'exec ' + trampoline + '"$@"', file=fout)
+            fout.write('\n'.join(parts) + '\n')
         os.chmod(runner, 0o700)
 
     def uninstall(self) -> None:
@@ -268,39 +524,40 @@ class CronDir:
         """
         cron_lst = [spec for spec in self.get_cron_lst()
                     if spec.level() >= min_level]
-        iters = [spec.gen_inv(start, iid)
+        iters = [itertools.takewhile(lambda inv: inv.dt <= end,
+                                     spec.gen_inv(start, iid))
                  for iid, spec in enumerate(cron_lst)]
-        for cron_inv in heapq.merge(*iters, key=CronInv.key):
-            if cron_inv.dt > end:
-                break
-            yield cron_inv
+        yield from heapq.merge(*iters, key=operator.attrgetter('dt', 'iid'))
 
     def runner_path(self) -> str:
         "Return the location of runner"
-        hostname = subprocess.check_output(['hostname', '-s']).decode().strip()
-        return os.path.join(
-            self._path, '.cronrepo-%s-%s.sh' % (hostname, self._target))
+        if self._runner_path is None:
+            hostname = socket.gethostname().split('.')[0]
+            self._runner_path = os.path.join(
+                self._path, '.cronrepo-%s-%s.sh' % (hostname, self._target))
+        return self._runner_path
 
     def stripped_crontab(self) -> str:
         "Return the crontab entries except those generated by this CronDir"
         crontab = subprocess.run(
             ['crontab', '-l'], stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL, check=False).stdout.decode()
+            stderr=subprocess.DEVNULL, check=False,
+            encoding='utf-8').stdout
         start_marker, end_marker = self.markers()
         crontab_lines = crontab.split('\n')
         if crontab_lines[-1] == '':
             crontab_lines.pop()
-        try:
-            start_idx = crontab_lines.index(start_marker)
-            end_idx = crontab_lines.index(end_marker)
-            if start_idx < end_idx:
-                crontab_lines = (
-                    crontab_lines[0:start_idx] if start_idx else []
-                ) + crontab_lines[end_idx + 1:]
-                crontab_lines = [l for l in crontab_lines
-                                 if l not in (start_marker, end_marker)]
-        except ValueError:
-            pass
+        start_idx = end_idx = -1
+        for idx, line in enumerate(crontab_lines):
+            if start_idx < 0 and line == start_marker:
+                start_idx = idx
+            elif end_idx < 0 and line == end_marker:
+                end_idx = idx
+            if start_idx >= 0 and end_idx >= 0:
+                break
+        if 0 <= start_idx < end_idx:
+            crontab_lines = crontab_lines[:start_idx] \
+                + crontab_lines[end_idx + 1:]
         crontab_lines.append('')
         return '\n'.join(crontab_lines)
 
@@ -319,7 +576,12 @@ def install_crontab(cron_tab: str) -> None:
         cron_tab: The string to install
 
     """
-    subprocess.run(['crontab', '-'], input=cron_tab.encode(), check=True)
+    with tempfile.NamedTemporaryFile('wt', delete=False) as fout:
+        fout.write(cron_tab)
+    try:
+        subprocess.run(['crontab', fout.name], check=True)
+    finally:
+        os.remove(fout.name)
 
 
 class CronInv:
@@ -346,7 +608,7 @@ class CronInv:
         "Convert to a string suitable for printing"
         tm_str = self.dt.strftime('date=%Y-%m-%d time=%H:%M')
         name = os.path.basename(self.cron_spec.path)
-        jid = self.cron_spec.cron_info['jid']
+        jid = self.cron_spec.jid
         level = self.cron_spec.level()
         cmd = self.cron_spec.cmd_str(runner)
         return '# %s name=%s jid=%s level=%s\n%s' % (
@@ -1,15 +1,13 @@
 "The main entry point of cronrepo"
 
 import datetime
+import functools
 import os
 import re
 import signal
-import subprocess
 import sys
 import typing
 
-import cronrepo
-
 
 def cronrepo_mgr() -> None:
     "Main entry of the manager"
@@ -19,6 +17,9 @@ def cronrepo_mgr() -> None:
 
 class RunParam:
     "Parameters found by cronrepo_run"
+
+    __slots__ = ('name', 'logdir', 'notifier', 'rotate')
+
     def __init__(self) -> None:
         self.name = ''
         self.logdir = ''
@@ -32,91 +33,307 @@ class RunParam:
         ret.name = name if sep else suf
         if os.environ.get('CRONREPO_JID'):
             ret.name += '%' + os.environ["CRONREPO_JID"]
-        os.environ['CRONREPO_NAME'] = ret.name
+        _setenv('CRONREPO_NAME', ret.name)
         if 'CRONREPO_DATE' not in os.environ:
-            run_date = datetime.date.today()
-            os.environ['CRONREPO_DATE'] = run_date.strftime('%Y-%m-%d')
+            run_date, date_str = _today()
+            _setenv('CRONREPO_DATE', date_str)
         else:
             run_date = datetime.datetime.strptime(
                 os.environ['CRONREPO_DATE'], '%Y-%m-%d').date()
-        with open(cronrepo_rc) as fin:
-            for line in fin:
-                key, sep, val = line.rstrip('\n').partition('=')
-                if key == 'CRONREPO_LOG':
-                    logdir = run_date.strftime(val)
-                    logdir = os.path.expandvars(logdir)
-                    logdir = os.path.expanduser(logdir)
-                    os.environ['CRONREPO_LOG'] = ret.logdir = logdir
-                elif key == 'NOTIFIER':
-                    ret.notifier = val
-                elif key == 'ROTATE':
-                    ret.rotate = int(val)
+        rc_info = _load_rc(cronrepo_rc, os.stat(cronrepo_rc).st_mtime_ns)
+        if 'CRONREPO_LOG' in rc_info:
+            logdir = run_date.strftime(rc_info['CRONREPO_LOG'])
+            if '$' in logdir:
+                logdir = os.path.expandvars(logdir)
+            if logdir.startswith('~'):
+                logdir = os.path.expanduser(logdir)
+            ret.logdir = logdir
+            _setenv('CRONREPO_LOG', logdir)
+        if 'NOTIFIER' in rc_info:
+            ret.notifier = rc_info['NOTIFIER']
+        if 'ROTATE' in rc_info:
+            ret.rotate = int(rc_info['ROTATE'])
         assert ret.logdir, 'Log dir must be defined'
         return ret
 
 
+def _setenv(key: str, val: str) -> None:
+    "Set an environment variable, skipping the putenv call if unchanged"
+    if os.environ.get(key) != val:
+        os.environ[key] = val
+
+
+_TODAY_CACHE = (
+    0, datetime.date.min, '')  # type: typing.Tuple[int, datetime.date, str]
+"Cached (ordinal, date, ISO string) of today, refreshed when stale"
+
+
+def _today() -> typing.Tuple[datetime.date, str]:
+    "Get today's date and its ISO date string, formatted once per day"
+    global _TODAY_CACHE  # pylint: disable=global-statement
+    run_date = datetime.date.today()
+    ordinal = run_date.toordinal()
+    if ordinal != _TODAY_CACHE[0]:
+        _TODAY_CACHE = (ordinal, run_date, run_date.strftime('%Y-%m-%d'))
+    return _TODAY_CACHE[1], _TODAY_CACHE[2]
+
+
+_RC_RE = re.compile(r'^(CRONREPO_LOG|NOTIFIER|ROTATE)=(.*)$', re.M)
+"Regex matching the recognized cronrepo.rc settings"
+
+
+@functools.lru_cache(maxsize=16)
+def _load_rc(path: str, _mtime_ns: int) -> typing.Dict[str, str]:
+    """Parse a cronrepo.rc file into a key-value mapping
+
+    Args:
+        path: Path to the rc file
+        _mtime_ns: The file modification time, keying the cache to the
+            file version so an edited rc file is re-read
+
+    """
+    with open(path) as fin:
+        text = fin.read()
+    return {match.group(1): match.group(2)
+            for match in _RC_RE.finditer(text)}
+
+
 IGNORED_SIGS = (signal.SIGINT, signal.SIGQUIT, signal.SIGTERM, signal.SIGPIPE)
-"Signals to ignore when monitoring"
+"Signals to block while monitoring a job"
 
 
 def cronrepo_run() -> None:
     "Main entry of the default trampoline"
-    args = sys.argv[1:]
+    args, debug = _parse_run_args(sys.argv[1:])
+    exit(_run_job(args, debug))
+
+
+def _parse_run_args(args: typing.List[str]) \
+        -> typing.Tuple[typing.List[str], bool]:
+    "Split the trampoline argument list into (job args, debug flag)"
     debug = False
     if args[0] == '-d':
         debug = True
-        del args[0]
+        args = args[1:]
+    return args, debug
+
+
+def _run_job(args: typing.List[str], debug: bool,
+             may_exec: bool = True) -> int:
+    """Run a cron job with logging and markers, returning its exit code
+
+    Args:
+        args: The command and arguments of the job
+        debug: Whether to print failures instead of notifying
+        may_exec: Whether the current process may be replaced by the
+            job on the no-rc fast path
+
+    """
     cronrepo_rc = os.path.join(os.path.dirname(args[0]), 'cronrepo.rc')
     if not os.path.exists(cronrepo_rc):
-        for sig in (signal.SIGPIPE, signal.SIGXFSZ):
-            signal.signal(sig, signal.SIG_DFL)
-        os.execl(args[0], *args)
+        if may_exec:
+            for sig in (signal.SIGPIPE, signal.SIGXFSZ):
+                signal.signal(sig, signal.SIG_DFL)
+            os.execv(args[0], args)
+        pid = os.posix_spawnp(
+            args[0], args, os.environ,
+            setsigdef=[signal.SIGPIPE, signal.SIGXFSZ])
+        return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
     param = RunParam.get(args[0], cronrepo_rc)
-    for sig in IGNORED_SIGS:
-        signal.signal(sig, signal.SIG_IGN)
-    os.makedirs(param.logdir, exist_ok=True)
+    signal.pthread_sigmask(signal.SIG_BLOCK, IGNORED_SIGS)
+    _ensure_logdir(param.logdir)
     logbase = os.path.join(param.logdir, param.name)
     logname = logbase + '.log'
-    _logrotate(logname, 0, param.rotate)
-    for suffix in ('.completed', '.failed'):
-        try:
-            os.remove(logbase + suffix)
-        except OSError:
-            pass
-    with open(logbase + '.running', 'w'):
+    _logrotate(logname, param.rotate)
+    stale = {param.name + '.completed', param.name + '.failed'}
+    with os.scandir(param.logdir) as dir_it:
+        for entry in dir_it:
+            if entry.name in stale:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:  # lost race with concurrent run
+                    pass
+                stale.discard(entry.name)
+                if not stale:
+                    break
+    running = logbase + '.running'
+    with open(running, 'w'):
         pass
-    with open(logname, 'wt') as outfd:
-        res = subprocess.run(args, stdout=outfd, stderr=subprocess.STDOUT,
-                             preexec_fn=_unignore_signals)
-    if res.returncode == 0:
-        os.rename(logbase + '.running', logbase + '.completed')
+    log_fd = os.open(logname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        pid = os.posix_spawnp(
+            args[0], args, os.environ,
+            file_actions=[
+                (os.POSIX_SPAWN_DUP2, log_fd, 1),
+                (os.POSIX_SPAWN_DUP2, log_fd, 2),
+            ],
+            setsigmask=(),
+            setsigdef=IGNORED_SIGS)
+    finally:
+        os.close(log_fd)
+    returncode = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+    if returncode == 0:
+        os.replace(running, logbase + '.completed')
     else:
-        os.rename(logbase + '.running', logbase + '.failed')
-        with open(logbase + '.failed', 'wt') as fout:
-            print(str(res.returncode), file=fout)
+        with open(running, 'wt') as fout:
+            print(str(returncode), file=fout)
+        os.replace(running, logbase + '.failed')
         if param.notifier:
             if debug:
-                print('Exit code:', res.returncode, file=sys.stderr)
+                print('Exit code:', returncode, file=sys.stderr)
             else:
-                subprocess.run(param.notifier, shell=True, check=False)
-    exit(res.returncode)
+                os.waitpid(os.posix_spawn(
+                    '/bin/sh', ['/bin/sh', '-c', param.notifier],
+                    os.environ), 0)
+    return returncode
+
+
+def _daemon_sock_path() -> str:
+    "Return the socket path used by cronrepo_rund and cronrepo_runc"
+    if 'CRONREPO_SOCK' in os.environ:
+        return os.environ['CRONREPO_SOCK']
+    import tempfile  # pylint: disable=import-outside-toplevel
+    return os.path.join(
+        os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()),
+        'cronrepo-%d.sock' % os.getuid())
+
+
+def cronrepo_rund() -> None:
+    """Main entry of the trampoline daemon
+
+    Listens on a UNIX socket for JSON job requests as sent by
+    cronrepo_runc, each carrying the trampoline arguments together with
+    the client environment and working directory, and runs each
+    received job in a forked child, so cron fires skip the interpreter
+    startup cost.  The child takes on the client environment and
+    directory before running the job, so the job sees exactly what the
+    runner script set up, and reports the job exit code back on the
+    connection.
 
+    """
+    import json  # pylint: disable=import-outside-toplevel
+    import socket  # pylint: disable=import-outside-toplevel
+    sock_path = _daemon_sock_path()
+    try:
+        os.remove(sock_path)
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    os.chmod(sock_path, 0o600)
+    server.listen()
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # auto-reap job runners
+    while True:
+        conn, _addr = server.accept()
+        with conn:
+            chunks = []
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            req = b''.join(chunks)
+            if not req:
+                continue
+            if os.fork():
+                continue
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            job = json.loads(req.decode())
+            os.chdir(job['cwd'])
+            os.environ.clear()
+            os.environ.update(job['env'])
+            args, debug = _parse_run_args(job['args'])
+            try:
+                ret = _run_job(args, debug, may_exec=False)
+            except Exception:  # pylint: disable=broad-except
+                ret = 1
+            conn.sendall(str(ret).encode())
+            os._exit(0)  # pylint: disable=protected-access
+
+
+def cronrepo_runc() -> None:
+    """Main entry of the trampoline daemon client
+
+    Forwards the trampoline arguments, the environment set up by the
+    runner script and the working directory to a running cronrepo_rund
+    and exits with the job exit code it reports.  Falls back to running
+    the job directly, like cronrepo_run, when no daemon is reachable.
 
-def _logrotate(base: str, cnt: int, limit: int) -> None:
-    logname = _logname(base, cnt)
-    if cnt >= limit or not os.path.exists(logname):
+    """
+    import json  # pylint: disable=import-outside-toplevel
+    import socket  # pylint: disable=import-outside-toplevel
+    args = sys.argv[1:]
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(_daemon_sock_path())
+    except OSError:
+        conn.close()
+        job_args, debug = _parse_run_args(args)
+        exit(_run_job(job_args, debug))
+    with conn:
+        conn.sendall(json.dumps({
+            'args': args,
+            'env': dict(os.environ),
+            'cwd': os.getcwd(),
+        }).encode())
+        conn.shutdown(socket.SHUT_WR)
+        reply = conn.recv(32).decode()
+    exit(int(reply) if reply else 1)
+
+
+_LAST_LOGDIR = ''
+"The log directory last ensured to exist by _ensure_logdir"
+
+
+def _ensure_logdir(logdir: str) -> None:
+    """Create the log directory if it does not exist yet
+
+    The common warm path costs one stat (or nothing, when the same
+    directory was already ensured in this process) instead of the mkdir
+    walk os.makedirs does.
+
+    Args:
+        logdir: The log directory path
+
+    """
+    global _LAST_LOGDIR  # pylint: disable=global-statement
+    if logdir == _LAST_LOGDIR:
         return
-    _logrotate(base, cnt + 1, limit)
-    os.rename(logname, _logname(base, cnt + 1))
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir, exist_ok=True)
+    _LAST_LOGDIR = logdir
 
 
-def _logname(base: str, cnt: int) -> str:
-    return '%s.%d' % (base, cnt) if cnt else base
+def _logrotate(logname: str, rotate: int) -> None:
+    """Rotate the log file, renaming only the active log
 
+    Rotated logs cycle through the suffixes .1 to .<rotate>, with the
+    current slot recorded in a pointer file, so each rotation is one
+    rename and one small write no matter how large rotate is.  The
+    newest rotated log is the one named in the pointer file.
 
-def _unignore_signals() -> None:
-    for sig in IGNORED_SIGS:
-        signal.signal(sig, signal.SIG_DFL)
+    Args:
+        logname: The path of the active log file
+        rotate: How many rotated logs to keep; 0 to keep none
+
+    """
+    if rotate <= 0:
+        return
+    idx_name = logname + '.idx'
+    try:
+        with open(idx_name) as fin:
+            idx = int(fin.read())
+    except (OSError, ValueError):
+        idx = 0
+    idx = idx % rotate + 1
+    try:
+        os.replace(logname, '%s.%d' % (logname, idx))
+    except FileNotFoundError:
+        return
+    with open(idx_name + '.tmp', 'w') as fout:
+        fout.write(str(idx))
+    os.replace(idx_name + '.tmp', idx_name)
 
 
 def mgr(action: str, crondir: str, *, target: str = '',
@@ -162,6 +379,7 @@ def mgr(action: str, crondir: str, *, target: str = '',
             listed.
 
     """
+    import cronrepo  # pylint: disable=import-outside-toplevel
     crondir_obj = cronrepo.CronDir(os.path.realpath(crondir), target)
     if action == 'generate':
         print(crondir_obj.generate(), end='')
@@ -23,6 +23,8 @@ setuptools.setup(
         "console_scripts": [
             "cronrepo=cronrepo.__main__:cronrepo_mgr",
             "cronrepo_run=cronrepo.__main__:cronrepo_run",
+            "cronrepo_rund=cronrepo.__main__:cronrepo_rund",
+            "cronrepo_runc=cronrepo.__main__:cronrepo_runc",
         ]
     },
     classifiers=[
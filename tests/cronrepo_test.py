@@ -1,6 +1,7 @@
 # pylint: disable=missing-docstring
 
 import datetime
+import itertools
 import os
 import subprocess
 import tempfile
@@ -40,6 +41,21 @@ def test_cron_spec() -> None:
         os.unlink(tmp_filename)
 
 
+def test_cron_spec_gen_inv() -> None:
+    spec = cronrepo.CronSpec.recognize_cron_line(
+        'foo', '# CRON@t1::*/20 3 29 2 *')
+    assert spec
+    invs = list(itertools.islice(
+        spec.gen_inv(datetime.datetime(2020, 1, 1), 7), 4))
+    assert [inv.dt for inv in invs] == [
+        datetime.datetime(2020, 2, 29, 3, 0),
+        datetime.datetime(2020, 2, 29, 3, 20),
+        datetime.datetime(2020, 2, 29, 3, 40),
+        datetime.datetime(2024, 2, 29, 3, 0),
+    ]
+    assert invs[0].iid == 7
+
+
 @pytest.fixture
 def sample_crondir() -> typing.Iterator[str]:
     with tempfile.TemporaryDirectory() as tempname:
@@ -97,21 +113,26 @@ def test_crondir_stripped_crontab(
     crondir = cronrepo.CronDir(sample_crondir, 't1')
     mocker.patch('subprocess.run')
     proc_obj = subprocess.run.return_value = mocker.Mock()
-    proc_obj.stdout = ''.encode()
+    proc_obj.stdout = ''
     assert crondir.stripped_crontab() == ''
-    proc_obj.stdout = '# hello\n'.encode()
+    proc_obj.stdout = '# hello\n'
     assert crondir.stripped_crontab() == '# hello\n'
     start, end = crondir.markers()
-    proc_obj.stdout \
-        = ('# hello\n%s\n# foo\n%s\n# world\n' % (start, end)).encode()
+    proc_obj.stdout = '# hello\n%s\n# foo\n%s\n# world\n' % (start, end)
     assert crondir.stripped_crontab() == '# hello\n# world\n'
 
 
 def test_crondir_install_crontab(mocker: pytest_mock.MockFixture) -> None:
-    mocker.patch('subprocess.run')
+    calls = []
+
+    def _fake_run(cmd: typing.List[str], check: bool) -> None:
+        with open(cmd[1]) as fin:
+            calls.append((cmd[0], fin.read(), check))
+
+    mocker.patch('subprocess.run', side_effect=_fake_run)
     cronrepo.install_crontab('# hello\n')
-    subprocess.run.assert_called_once_with(
-        ['crontab', '-'], input='# hello\n'.encode(), check=True)
+    assert calls == [('crontab', '# hello\n', True)]
+    assert not os.path.exists(subprocess.run.call_args[0][0][1])
 
 
 def test_crondir_install(